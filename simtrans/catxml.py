@@ -4,11 +4,120 @@
 """
 
 import sys
+import copy
+import mmap
 from optparse import OptionParser, OptionError
 import lxml.etree
 from . import utils
 
 
+def mapfile(f):
+    '''
+    Map the file into memory so that the parser reads it without extra copies
+    '''
+    with open(f, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm
+
+
+def readroot(f):
+    '''
+    Read tag, attributes and namespaces of the root element without parsing the whole file
+    '''
+    for event, elem in lxml.etree.iterparse(f, events=('start',)):
+        return (elem.tag, dict(elem.attrib), elem.nsmap)
+
+
+def iterchildren(f):
+    '''
+    Iterate over direct children (including comments and processing
+    instructions) of the root element, releasing each one after use
+    '''
+    depth = 0
+    for event, elem in lxml.etree.iterparse(f, events=('start', 'end', 'comment', 'pi')):
+        if event == 'start':
+            depth = depth + 1
+            continue
+        if event == 'end':
+            depth = depth - 1
+        if depth == 1:
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+def stripnamespaces(data, nsmap):
+    '''
+    Remove namespace declarations which are already made by the root element
+    from the start tag of serialized child element
+
+    >>> stripnamespaces(b'<x:link xmlns:x="u" xmlns:y="v" name="l"/>', {'x': 'u'})
+    b'<x:link xmlns:y="v" name="l"/>'
+    >>> stripnamespaces(b'<link xmlns="d" xmlns:x="w"><x:a xmlns:x="u"/></link>', {None: 'd', 'x': 'u'})
+    b'<link xmlns:x="w"><x:a xmlns:x="u"/></link>'
+    '''
+    end = data.find(b'>')
+    head = data[:end]
+    for prefix, uri in nsmap.items():
+        if prefix is None:
+            decl = ' xmlns="%s"' % uri
+        else:
+            decl = ' xmlns:%s="%s"' % (prefix, uri)
+        head = head.replace(decl.encode('utf-8'), b'', 1)
+    return head + data[end:]
+
+
+def concatenate(files, output):
+    '''
+    Write children of the root elements of all the files into the root element of the first file
+
+    The text before the first child of the first root and the tails of all
+    the children are kept as is, so the original indentation is preserved.
+
+    >>> import io, os, tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> a = os.path.join(d, 'a.xml')
+    >>> b = os.path.join(d, 'b.xml')
+    >>> _ = open(a, 'w').write('<robot name="a" xmlns:xacro="http://ros.org/wiki/xacro">\\n'
+    ...                        '  <link name="l1"><visual/></link>\\n  <!-- note -->\\n</robot>')
+    >>> _ = open(b, 'w').write('<robot name="b" xmlns:xacro="http://ros.org/wiki/xacro">\\n'
+    ...                        '  <?pi test?>\\n  <xacro:property name="p" value="1"/>\\n</robot>')
+    >>> out = io.BytesIO()
+    >>> concatenate([mapfile(a), mapfile(b)], out)
+    >>> print(out.getvalue().decode('utf-8'))
+    <robot xmlns:xacro="http://ros.org/wiki/xacro" name="a">
+      <link name="l1"><visual/></link>
+      <!-- note -->
+    <?pi test?>
+      <xacro:property name="p" value="1"/>
+    </robot>
+    <BLANKLINE>
+    '''
+    (tag, attrib, nsmap) = readroot(files[0])
+    if hasattr(files[0], 'seek'):
+        files[0].seek(0)
+    # children are serialized by ourselves and written directly to the
+    # output, so the writer must not buffer
+    with lxml.etree.xmlfile(output, encoding='utf-8', buffered=False) as xf:
+        with xf.element(tag, attrib=attrib, nsmap=nsmap):
+            first = True
+            for f in files:
+                for elem in iterchildren(f):
+                    if first:
+                        text = elem.getparent().text
+                        if text:
+                            xf.write(text)
+                        first = False
+                    # serialize a detached copy, which only declares the
+                    # namespaces it uses (not all of its original root)
+                    data = lxml.etree.tostring(copy.deepcopy(elem), encoding='utf-8', with_tail=True)
+                    output.write(stripnamespaces(data, nsmap))
+    output.write(b'\n')
+
+
 def main():
     usage = '''Usage: %prog [options] xmlfile1 xmlfile2 ...
 Concatinate multiple xml files.'''
@@ -25,13 +134,17 @@ Concatinate multiple xml files.'''
         print(parser.print_help(), file=sys.stderr)
         return 1
 
-    d = lxml.etree.parse(utils.resolveFile(args[0]))
-    r = d.getroot()
-    for f in args[1:]:
-        d2 = lxml.etree.parse(utils.resolveFile(f))
-        r.extend(d2.getroot())
-
-    print(lxml.etree.tostring(r, pretty_print=True))
+    maps = []
+    try:
+        for f in args:
+            maps.append(mapfile(utils.resolveFile(f)))
+        # flush the text layer first since we write to the binary buffer below
+        sys.stdout.flush()
+        concatenate(maps, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+    finally:
+        for mm in maps:
+            mm.close()
 
     return 0
 
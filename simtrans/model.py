@@ -7,6 +7,7 @@ Common data structure for model converter
 
 from __future__ import absolute_import
 import logging
+import copy
 import numpy
 import warnings
 with warnings.catch_warnings():
@@ -149,6 +150,18 @@ class TransformationModel(object):
         self.rot = None
         self.scale = None
 
+    def clone(self):
+        '''
+        Shallow copy of the model with its own copy of the transformation arrays
+        '''
+        o = self.__class__.__new__(self.__class__)
+        o.__dict__.update(self.__dict__)
+        for attr in ['matrix', 'trans', 'scale', 'rot']:
+            v = getattr(self, attr)
+            if v is not None:
+                setattr(o, attr, copy.copy(v))
+        return o
+
 
 class BodyModel(TransformationModel):
     """
@@ -291,6 +304,37 @@ class LinkModel(TransformationModel):
         ])
         return bbinertia
     
+    def clone(self):
+        '''
+        Copy of the link which can be translated without affecting the original
+
+        Shapes are cloned (keeping the ones shared between visuals and
+        collisions shared), shape data is not copied.
+
+        >>> l = LinkModel()
+        >>> s = ShapeModel()
+        >>> l.visuals = [s]
+        >>> l.collisions = [s]
+        >>> l2 = l.clone()
+        >>> l2.visuals[0] is s
+        False
+        >>> l2.visuals[0] is l2.collisions[0]
+        True
+        >>> l2.inertia is l.inertia
+        False
+        '''
+        o = TransformationModel.clone(self)
+        shapes = {}
+        def cloneshape(s):
+            if id(s) not in shapes:
+                shapes[id(s)] = s.clone()
+            return shapes[id(s)]
+        o.visuals = [cloneshape(s) for s in self.visuals]
+        o.collisions = [cloneshape(s) for s in self.collisions]
+        o.centerofmass = copy.copy(self.centerofmass)
+        o.inertia = copy.copy(self.inertia)
+        return o
+
     def translate(self, mat):
         self.matrix = numpy.dot(self.getmatrix(), mat)
         self.trans = None
@@ -53,7 +53,8 @@ import math
 import numpy
 import copy
 import jinja2
-import uuid
+import itertools
+import concurrent.futures
 try:
     import CORBA
     import CosNaming
@@ -66,6 +67,153 @@ except ImportError:
     print("$ sudo apt-get install openhrp openrtm-aist-python")
     pass
 
+_IDENTITY4 = numpy.identity(4)
+
+# fixed rotations to convert sensor frames in OpenHRP (Z-axis up) to X-axis up
+_VISION_FIXUP_Q = tf.quaternion_about_axis(math.pi, [1, 0, 0])
+_RANGE_FIXUP_Q = tf.quaternion_multiply(
+    tf.quaternion_multiply(tf.quaternion_about_axis(-math.pi/2, [0, 0, 1]),
+                           tf.quaternion_about_axis(math.pi/2, [0, 1, 0])),
+    tf.quaternion_about_axis(math.pi, [1, 0, 0]))
+
+
+_AXIS_EPS = numpy.finfo(float).eps * 4.0
+
+
+def quaternions_about_axes(rotations):
+    '''
+    Convert sequence of axis-angle rotations ([x, y, z, angle] * N) to quaternions in one pass
+
+    >>> q = quaternions_about_axes([[1, 0, 0, 0.123], [0, 0, 2, math.pi], [0, 0, 0, 1.0]])
+    >>> numpy.allclose(q[0], tf.quaternion_about_axis(0.123, [1, 0, 0]))
+    True
+    >>> numpy.allclose(q[1], tf.quaternion_about_axis(math.pi, [0, 0, 2]))
+    True
+    >>> numpy.allclose(q[2], tf.quaternion_about_axis(1.0, [0, 0, 0]))
+    True
+    '''
+    rotations = numpy.asarray(rotations, dtype=numpy.float64).reshape(-1, 4)
+    axes = rotations[:, 0:3]
+    half = rotations[:, 3] / 2.0
+    alen = numpy.sqrt(numpy.sum(axes * axes, axis=1))
+    # leave zero-length axes as is (same as quaternion_about_axis)
+    scale = numpy.sin(half) / numpy.where(alen > _AXIS_EPS, alen, 1.0)
+    scale[alen <= _AXIS_EPS] = 1.0
+    q = numpy.empty((rotations.shape[0], 4))
+    q[:, 0] = numpy.cos(half)
+    q[:, 1:4] = axes * scale[:, None]
+    return q
+
+
+def countslices(counts):
+    '''
+    Slices to split concatenated items back into groups of given counts
+
+    >>> countslices([0, 2, 0, 1, 0])
+    [slice(0, 0, None), slice(0, 2, None), slice(2, 2, None), slice(2, 3, None), slice(3, 3, None)]
+    >>> items = ['a1', 'a2', 'c1']
+    >>> [items[sl] for sl in countslices([2, 0, 1])]
+    [['a1', 'a2'], [], ['c1']]
+    '''
+    slices = []
+    offset = 0
+    for c in counts:
+        slices.append(slice(offset, offset + c))
+        offset = offset + c
+    return slices
+
+
+def isidentity(m):
+    '''
+    Check whether 4x4 matrix is identity (same tolerance as numpy.allclose)
+
+    >>> isidentity(_IDENTITY4)
+    True
+    >>> isidentity(_IDENTITY4 + 1e-9)
+    True
+    >>> isidentity(tf.translation_matrix([0, 0, 1e-3]))
+    False
+    >>> isidentity(_IDENTITY4 * numpy.nan)
+    False
+    '''
+    d = numpy.asarray(m).ravel().tolist()
+    for i in range(16):
+        if i % 5 == 0:
+            if not abs(d[i] - 1) <= 1e-8 + 1e-5:
+                return False
+        elif not abs(d[i]) <= 1e-8:
+            return False
+    return True
+
+
+def rigidinverse(m):
+    '''
+    Inverse of 4x4 homogeneous transformation matrix (or stack of them)
+
+    Uses the closed form (transposed rotation) for rigid transformations and
+    falls back to numpy.linalg.inv for matrices with scale or shear.
+
+    >>> m = tf.concatenate_matrices(tf.translation_matrix([1, 2, 3]), tf.rotation_matrix(0.5, [0, 1, 1]))
+    >>> numpy.allclose(rigidinverse(m), numpy.linalg.inv(m))
+    True
+    >>> numpy.allclose(rigidinverse([m, _IDENTITY4]), [numpy.linalg.inv(m), _IDENTITY4])
+    True
+    >>> m = tf.concatenate_matrices(m, tf.scale_matrix(2.0))
+    >>> numpy.allclose(rigidinverse(m), numpy.linalg.inv(m))
+    True
+    '''
+    m = numpy.asarray(m, dtype=numpy.float64)
+    r = m[..., :3, :3]
+    rt = numpy.swapaxes(r, -1, -2)
+    if numpy.abs(m[..., 3, :] - _IDENTITY4[3]).max() > 1e-9 or numpy.abs(numpy.matmul(rt, r) - _IDENTITY4[:3, :3]).max() > 1e-9:
+        return numpy.linalg.inv(m)
+    inv = numpy.zeros_like(m)
+    inv[..., :3, :3] = rt
+    inv[..., :3, 3] = -numpy.matmul(rt, m[..., :3, 3:4])[..., 0]
+    inv[..., 3, 3] = 1
+    return inv
+
+
+def relativematrices(parents, children, index=None):
+    '''
+    Compute inv(parents[i]) * children[i] for stacks of 4x4 matrices in one pass
+
+    If index is given, compute inv(parents[index[i]]) * children[i] instead so
+    that each parent shared by several children is inverted only once.
+
+    >>> p = tf.concatenate_matrices(tf.translation_matrix([1, 2, 3]), tf.rotation_matrix(0.5, [0, 1, 1]))
+    >>> c = tf.concatenate_matrices(p, tf.translation_matrix([0, 0, 1]))
+    >>> numpy.allclose(relativematrices([p, p], [c, p]), [tf.translation_matrix([0, 0, 1]), _IDENTITY4])
+    True
+    >>> numpy.allclose(relativematrices([p], [c, p], [0, 0]), [tf.translation_matrix([0, 0, 1]), _IDENTITY4])
+    True
+    >>> relativematrices([], []).shape
+    (0, 4, 4)
+    '''
+    parents = numpy.asarray(parents, dtype=numpy.float64).reshape(-1, 4, 4)
+    children = numpy.asarray(children, dtype=numpy.float64).reshape(-1, 4, 4)
+    if len(children) == 0:
+        return numpy.empty((0, 4, 4))
+    invs = rigidinverse(parents)
+    if index is not None:
+        invs = invs[numpy.asarray(index, dtype=numpy.intp)]
+    return numpy.matmul(invs, children)
+
+
+def rendershape(job):
+    '''
+    Render mesh shape to vrml file (called from worker processes of VRMLWriter)
+    '''
+    (fname, name, data) = job
+    template = VRMLWriter.gettemplate('vrml-mesh.wrl')
+    with open(fname, 'w', buffering=1 << 20) as ofile:
+        template.stream({
+            'name': name,
+            'ShapeModel': model.ShapeModel,
+            'mesh': {'children': [data]}
+        }).dump(ofile)
+
+
 plist = []
 def terminator():
     global plist
@@ -91,6 +239,9 @@ class VRMLReader(object):
         self._linknamemap['world'] = 'world'
         self._materials = []
         self._sensors = []
+        self._linkrots = {}
+        self._sensorrots = {}
+        self._meshes = []
         self._assethandler = None
 
     def read(self, f, assethandler=None, options=None):
@@ -104,18 +255,21 @@ class VRMLReader(object):
         except (CosNaming.NamingContext.NotFound, CORBA.TRANSIENT):
             logging.info("try running openhrp-model-loader")
             plist.append(subprocess.Popen(["openhrp-model-loader"]))
-            for t in range(0, 6):
-                if t == 5:
-                    logging.error("unable to find openhrp-model-loader")
-                    raise CosNaming.NamingContext.NotFound
+            # poll with increasing interval (about 5 seconds in total) so
+            # that we can continue as soon as the loader is ready
+            for delay in [0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 2.0]:
+                time.sleep(delay)
                 try:
                     self.resolveModelLoader()
                     self._loader.clearData()
                 except (CosNaming.NamingContext.NotFound, CORBA.TRANSIENT):
-                    time.sleep(1)
+                    pass
                 else:
                     logging.info("resolved openhrp-model-loader")
                     break
+            else:
+                logging.error("unable to find openhrp-model-loader")
+                raise CosNaming.NamingContext.NotFound
         try:
             self._model = self._loader.loadBodyInfo(f)
         except CORBA.TRANSIENT:
@@ -127,12 +281,21 @@ class VRMLReader(object):
         self._links = []
         self._materials = []
         self._sensors = []
+        self._meshes = []
         self._hrplinks = self._model._get_links()
         self._hrpshapes = self._model._get_shapes()
         self._hrpapperances = self._model._get_appearances()
         self._hrpmaterials = self._model._get_materials()
         self._hrptextures = self._model._get_textures()
         self._hrpextrajoints = self._model._get_extraJoints()
+        self._linkrots = dict(zip([l.name for l in self._hrplinks],
+                                  quaternions_about_axes([l.rotation for l in self._hrplinks])))
+        # convert sensor rotations of all the links at once, then
+        # split them per link
+        sensorrots = quaternions_about_axes([s.rotation for l in self._hrplinks for s in l.sensors])
+        self._sensorrots = {}
+        for l, sl in zip(self._hrplinks, countslices([len(l.sensors) for l in self._hrplinks])):
+            self._sensorrots[l.name] = sensorrots[sl]
         mid = 0
         for a in self._hrpmaterials:
             m = model.MaterialModel()
@@ -176,8 +339,62 @@ class VRMLReader(object):
             j.parent = self._linknamemap[j.parent]
             j.child = self._linknamemap[j.child]
         bm.sensors = self._sensors
+        self.packMeshes()
         return bm
 
+    def packMeshes(self):
+        '''
+        Pack mesh arrays of the body into one contiguous array per attribute
+
+        Each mesh keeps its own attributes as views into the packed arrays.
+        Packing briefly doubles the peak mesh memory (while concatenating),
+        and each view keeps the whole packed array alive.
+
+        >>> r = VRMLReader.__new__(VRMLReader)
+        >>> r._meshes = []
+        >>> for i in range(3):
+        ...     m = model.MeshData()
+        ...     m.vertex = numpy.full((i + 1, 3), i, dtype=numpy.float32)
+        ...     m.vertex_index = numpy.full((i + 1, 3), i, dtype=numpy.int32)
+        ...     m.normal = m.vertex.copy()
+        ...     m.normal_index = m.vertex_index
+        ...     r._meshes.append(m)
+        >>> meshes = list(r._meshes)
+        >>> meshes[1].normal_index = numpy.array([[7, 7, 7], [8, 8, 8]], dtype=numpy.int32)
+        >>> r.packMeshes()
+        >>> [m.vertex[:, 0].tolist() for m in meshes]
+        [[0.0], [1.0, 1.0], [2.0, 2.0, 2.0]]
+        >>> meshes[1].normal_index.tolist()
+        [[7, 7, 7], [8, 8, 8]]
+        >>> meshes[0].normal_index is meshes[0].vertex_index
+        True
+        >>> meshes[0].vertex.base is meshes[2].vertex.base
+        True
+        >>> meshes[0].vertex_index.base is meshes[1].vertex_index.base
+        True
+        '''
+        shared = set(id(m) for m in self._meshes if m.normal_index is m.vertex_index)
+        for attr in ['vertex', 'vertex_index', 'normal', 'normal_index', 'uvmap', 'uvmap_index']:
+            meshes = []
+            for m in self._meshes:
+                a = getattr(m, attr)
+                if attr == 'normal_index' and id(m) in shared:
+                    continue
+                if isinstance(a, numpy.ndarray) and len(a) > 0:
+                    meshes.append(m)
+            if len(meshes) <= 1:
+                continue
+            arrays = [getattr(m, attr) for m in meshes]
+            arena = numpy.concatenate(arrays)
+            offset = 0
+            for m, a in zip(meshes, arrays):
+                setattr(m, attr, arena[offset:offset + len(a)])
+                offset = offset + len(a)
+        for m in self._meshes:
+            if id(m) in shared:
+                m.normal_index = m.vertex_index
+        self._meshes = []
+
     def readLink(self, m):
         lm = model.LinkModel()
         if len(m.segments) > 0:
@@ -189,7 +406,7 @@ class VRMLReader(object):
         lm.centerofmass = numpy.array(m.centerOfMass)
         lm.inertia = numpy.array(m.inertia).reshape(3, 3)
         lm.visuals = []
-        for s in m.sensors:
+        for s, rot in zip(m.sensors, self._sensorrots.get(m.name, [])):
             sm = model.SensorModel()
             sm.name = s.name
             sm.parent = lm.name
@@ -197,9 +414,9 @@ class VRMLReader(object):
             # sensors in OpenHRP is defined based on Z-axis up. so we
             # will rotate them to X-axis up here.
             # see http://www.openrtp.jp/openhrp3/jp/create_model.html
-            sm.rot = tf.quaternion_about_axis(s.rotation[3], s.rotation[0:3])
+            sm.rot = rot
             if s.type == 'Vision':
-                sm.rot = tf.quaternion_multiply(sm.rot, tf.quaternion_about_axis(math.pi, [1, 0, 0]))
+                sm.rot = tf.quaternion_multiply(sm.rot, _VISION_FIXUP_Q)
                 sm.sensorType = model.SensorModel.SS_CAMERA
                 sm.data = model.CameraData()
                 sm.data.near = s.specValues[0]
@@ -219,9 +436,7 @@ class VRMLReader(object):
                 sm.data.height = s.specValues[5]
                 sm.rate = s.specValues[6]
             elif s.type == 'Range':
-                rot = tf.quaternion_multiply(sm.rot, tf.quaternion_about_axis(-math.pi/2, [0, 0, 1]))
-                rot = tf.quaternion_multiply(rot, tf.quaternion_about_axis(math.pi/2, [0, 1, 0]))
-                sm.rot = tf.quaternion_multiply(rot, tf.quaternion_about_axis(math.pi, [1, 0, 0]))
+                sm.rot = tf.quaternion_multiply(sm.rot, _RANGE_FIXUP_Q)
                 sm.sensorType = model.SensorModel.SS_RAY
                 sm.data = model.RayData()
                 (scanangle, scanstep, scanrate, maxdistance) = s.specValues
@@ -234,23 +449,24 @@ class VRMLReader(object):
         for s in m.shapeIndices:
             sm = model.ShapeModel()
             sm.name = lm.name + "-shape-%i" % s.shapeIndex
-            sm.matrix = numpy.matrix(s.transformMatrix+[0, 0, 0, 1]).reshape(4, 4)
+            sm.matrix = numpy.asarray(s.transformMatrix+[0, 0, 0, 1], dtype=numpy.float64).reshape(4, 4)
             sdata = self._hrpshapes[s.shapeIndex]
+            identity = sdata.primitiveType != OpenHRP.SP_MESH and isidentity(sm.matrix)
             if sdata.primitiveType == OpenHRP.SP_MESH:
                 sm.shapeType = model.ShapeModel.SP_MESH
                 sm.data = self.readMesh(sdata)
-            elif sdata.primitiveType == OpenHRP.SP_SPHERE and numpy.allclose(sm.matrix, numpy.identity(4)):
+            elif sdata.primitiveType == OpenHRP.SP_SPHERE and identity:
                 sm.shapeType = model.ShapeModel.SP_SPHERE
                 sm.data = model.SphereData()
                 sm.data.radius = sdata.primitiveParameters[0]
                 sm.data.material = self._materials[sdata.appearanceIndex]
-            elif sdata.primitiveType == OpenHRP.SP_CYLINDER and numpy.allclose(sm.matrix, numpy.identity(4)):
+            elif sdata.primitiveType == OpenHRP.SP_CYLINDER and identity:
                 sm.shapeType = model.ShapeModel.SP_CYLINDER
                 sm.data = model.CylinderData()
                 sm.data.radius = sdata.primitiveParameters[0]
                 sm.data.height = sdata.primitiveParameters[1]
                 sm.data.material = self._materials[sdata.appearanceIndex]
-            elif sdata.primitiveType == OpenHRP.SP_BOX and numpy.allclose(sm.matrix, numpy.identity(4)):
+            elif sdata.primitiveType == OpenHRP.SP_BOX and identity:
                 sm.shapeType = model.ShapeModel.SP_BOX
                 sm.data = model.BoxData()
                 sm.data.x = sdata.primitiveParameters[0]
@@ -267,31 +483,23 @@ class VRMLReader(object):
 
     def readMesh(self, sdata):
         data = model.MeshData()
-        data.vertex = numpy.array(sdata.vertices).reshape(len(sdata.vertices)/3, 3)
-        data.vertex_index = numpy.array(sdata.triangles).reshape(len(sdata.triangles)/3, 3)
+        data.vertex = numpy.asarray(sdata.vertices, dtype=numpy.float32).reshape(-1, 3)
+        data.vertex_index = numpy.asarray(sdata.triangles, dtype=numpy.int32).reshape(-1, 3)
         adata = self._hrpapperances[sdata.appearanceIndex]
         if adata.normalPerVertex is True:
-            data.normal = numpy.array(adata.normals).reshape(len(adata.normals)/3, 3)
+            data.normal = numpy.asarray(adata.normals, dtype=numpy.float32).reshape(-1, 3)
             if len(adata.normalIndices) > 0:
-                data.normal_index = numpy.array(adata.normalIndices).reshape(len(adata.normalIndices)/3, 3)
+                data.normal_index = numpy.asarray(adata.normalIndices, dtype=numpy.int32).reshape(-1, 3)
             else:
                 data.normal_index = data.vertex_index
         else:
-            data.normal = numpy.array(adata.normals).reshape(len(adata.normals)/3, 3)
+            data.normal = numpy.asarray(adata.normals, dtype=numpy.float32).reshape(-1, 3)
             if len(adata.normalIndices) > 0:
-                idx = []
-                for i in adata.normalIndices:
-                    idx.append(i)
-                    idx.append(i)
-                    idx.append(i)
-                data.normal_index = numpy.array(idx).reshape(len(idx)/3, 3)
+                idx = numpy.asarray(adata.normalIndices, dtype=numpy.int32)
             else:
-                idx = []
-                for i in range(0, len(adata.normals)/3):
-                    idx.append(i)
-                    idx.append(i)
-                    idx.append(i)
-                data.normal_index = numpy.array(idx).reshape(len(idx)/3, 3)
+                idx = numpy.arange(len(adata.normals)//3, dtype=numpy.int32)
+            # one normal per face, shared by all three vertices
+            data.normal_index = numpy.repeat(idx, 3).reshape(-1, 3)
 #        if len(data.vertex_index) != len(data.normal_index):
 #            raise Exception('vertex length and normal length not match')
         if adata.materialIndex >= 0:
@@ -302,11 +510,22 @@ class VRMLReader(object):
                 data.material.texture = self._assethandler(fname)
             else:
                 data.material.texture = fname
-            data.uvmap = numpy.array(adata.textureCoordinate).reshape(len(adata.textureCoordinate)/2, 2)
-            data.uvmap_index = numpy.array(adata.textureCoordIndices).reshape(len(adata.textureCoordIndices)/3, 3)
+            data.uvmap = numpy.asarray(adata.textureCoordinate, dtype=numpy.float32).reshape(-1, 2)
+            data.uvmap_index = numpy.asarray(adata.textureCoordIndices, dtype=numpy.int32).reshape(-1, 3)
+        self._meshes.append(data)
         return data
 
     def readChild(self, parent, child):
+        # traverse the subtree with an explicit stack (in the same
+        # depth-first order as recursive traversal)
+        stack = [(parent, child)]
+        while stack:
+            (parent, child) = stack.pop()
+            jm = self.readJoint(parent, child)
+            for c in reversed(child.childIndices):
+                stack.append((jm, self._hrplinks[c]))
+
+    def readJoint(self, parent, child):
         # first, create joint pairs
         jm = model.JointModel()
         jm.parent = parent.name
@@ -343,7 +562,7 @@ class VRMLReader(object):
         else:
             raise Exception('unsupported joint type: %s' % child.jointType)
         jm.trans = numpy.array(child.translation)
-        jm.rot = tf.quaternion_about_axis(child.rotation[3], child.rotation[0:3])
+        jm.rot = self._linkrots[child.name]
         # convert to absolute position
         jm.matrix = numpy.dot(parent.getmatrix(), jm.getmatrix())
         jm.trans = None
@@ -355,8 +574,7 @@ class VRMLReader(object):
         lm.trans = None
         lm.rot = None
         self._links.append(lm)
-        for c in child.childIndices:
-            self.readChild(jm, self._hrplinks[c])
+        return jm
 
     def resolveModelLoader(self):
         nsobj = self._orb.resolve_initial_references("NameService")
@@ -373,17 +591,68 @@ class VRMLWriter(object):
     '''
     VRML writer class
     '''
+    _env = None        # jinja2 environment shared by all writers
+    _templates = {}    # compiled templates by name
+
     def __init__(self):
         self._linkmap = {}
         self._roots = []
         self._ignore = []
         self._options = None
+        self._matrixcache = {}
+        self._relatives = {}
+        self._childjoints = {}
+        self._uniq = itertools.count()
 
     def write(self, mdata, fname, options=None):
         '''
         Write simulation model in VRML format
+
+        Shape files are rendered in worker processes when options.parallel
+        is set, which gives the same files as serial rendering
+
+        >>> import argparse, filecmp, tempfile
+        >>> def mkbody():
+        ...     b = model.BodyModel()
+        ...     b.name = 'body'
+        ...     for i in range(3):
+        ...         l = model.LinkModel()
+        ...         l.name = 'link%i' % i
+        ...         l.mass = 1.0
+        ...         s = model.ShapeModel()
+        ...         s.name = 'shape%i' % i
+        ...         s.shapeType = model.ShapeModel.SP_MESH
+        ...         s.data = model.MeshData()
+        ...         s.data.vertex = numpy.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], dtype=float)
+        ...         s.data.vertex_index = numpy.array([[0, 1, 2]])
+        ...         l.visuals = [s]
+        ...         l.collisions = []
+        ...         b.links.append(l)
+        ...     for i in range(1, 3):
+        ...         j = model.JointModel()
+        ...         j.name = 'joint%i' % i
+        ...         j.parent = 'link%i' % (i - 1)
+        ...         j.child = 'link%i' % i
+        ...         j.jointType = model.JointModel.J_REVOLUTE
+        ...         j.axis = model.AxisData()
+        ...         j.axis.axis = [0, 0, 1]
+        ...         j.trans = numpy.array([0.1, 0, 0])
+        ...         b.joints.append(j)
+        ...     return b
+        >>> options = argparse.Namespace(usecollision=False, useboth=False, parallel=False)
+        >>> d1 = tempfile.mkdtemp()
+        >>> VRMLWriter().write(mkbody(), os.path.join(d1, 'body.wrl'), options)
+        >>> options.parallel = True
+        >>> d2 = tempfile.mkdtemp()
+        >>> VRMLWriter().write(mkbody(), os.path.join(d2, 'body.wrl'), options)
+        >>> files = sorted(f for f in os.listdir(d1) if f.endswith('.wrl'))
+        >>> files
+        ['body-link0-shape0.wrl', 'body-link1-shape1.wrl', 'body-link2-shape2.wrl', 'body.wrl']
+        >>> filecmp.cmpfiles(d1, d2, files, shallow=False)[0] == files
+        True
         '''
         self._options = options
+        self._matrixcache = {}
         fpath, fext = os.path.splitext(fname)
         basename = os.path.basename(fpath)
         dirname = os.path.dirname(fname)
@@ -402,7 +671,7 @@ class VRMLWriter(object):
                 nl.rot = None
                 nl.mass = 0.001 # assign very small mass
                 mdata.links.append(nl)
-                nj = copy.deepcopy(j)
+                nj = j.clone()
                 nj.name = j.name + "_SECOND"
                 nj.jointType = model.JointModel.J_REVOLUTE
                 nj.parent = nl.name
@@ -413,34 +682,30 @@ class VRMLWriter(object):
                 j.child = nl.name
 
         # check for same names in visuals or collisions
-        usednames = {}
+        usednames = set()
+        addname = usednames.add
         for l in mdata.links:
-            for v in l.visuals:
-                if v.name in usednames:
-                    v.name = l.name + "-visual"
-                    if v.name in usednames:
-                        v.name = l.name + "-visual-" + str(uuid.uuid1()).replace('-', '')
-                usednames[v.name] = True
-            for c in l.collisions:
-                if c.name in usednames:
-                    c.name = l.name + "-collision"
-                    if c.name in usednames:
-                        c.name = l.name + "-collision-" + str(uuid.uuid1()).replace('-', '')
-                usednames[c.name] = True
+            for shapes, tag in ((l.visuals, 'visual'), (l.collisions, 'collision')):
+                for v in shapes:
+                    name = v.name
+                    if name in usednames:
+                        name = "%s-%s" % (l.name, tag)
+                        while name in usednames:
+                            name = "%s-%s-%i" % (l.name, tag, next(self._uniq))
+                        v.name = name
+                    addname(name)
 
         # find root joint (including local peaks)
         self._roots = utils.findroot(mdata)
 
         # render the data structure using template
-        loader = jinja2.PackageLoader(self.__module__, 'template')
-        env = jinja2.Environment(loader=loader, extensions=['jinja2.ext.do'])
-
         self._linkmap['world'] = model.LinkModel()
         for m in mdata.links:
             self._linkmap[m.name] = m
 
         # render shape vrml file for each links
         shapefilemap = {}
+        shapejobs = {}
         for l in mdata.links:
             shapes = copy.copy(l.visuals)
             if options is not None and options.usecollision:
@@ -450,22 +715,30 @@ class VRMLWriter(object):
             for v in shapes:
                 logging.info('writing shape of link: %s, type: %s' % (l.name, v.shapeType))
                 if v.shapeType == model.ShapeModel.SP_MESH:
-                    template = env.get_template('vrml-mesh.wrl')
                     if isinstance(v.data, model.MeshTransformData):
                         v.data.pretranslate()
-                    m = {}
-                    m['children'] = [v.data]
                     shapefname = (mdata.name + "-" + l.name + "-" + v.name + ".wrl").replace('::', '_')
-                    with open(os.path.join(dirname, shapefname), 'w') as ofile:
-                        ofile.write(template.render({
-                            'name': v.name,
-                            'ShapeModel': model.ShapeModel,
-                            'mesh': m
-                        }))
+                    shapejobs[shapefname] = (os.path.join(dirname, shapefname), v.name, v.data)
                     shapefilemap[v.name] = shapefname
+        # each shape is written to its own file, so they can be rendered
+        # in parallel (only on request, since it requires the caller to
+        # be safe to start worker processes from)
+        self.gettemplate('vrml-mesh.wrl')
+        parallel = options is not None and getattr(options, 'parallel', False)
+        if parallel and len(shapejobs) > 1:
+            workers = min(len(shapejobs), os.cpu_count() or 1)
+            try:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(rendershape, shapejobs.values()))
+            except concurrent.futures.process.BrokenProcessPool:
+                logging.warning('unable to render shapes in worker processes, fall back to serial rendering')
+                parallel = False
+        if not parallel or len(shapejobs) <= 1:
+            for job in shapejobs.values():
+                rendershape(job)
 
         # render main vrml file for each bodies
-        template = env.get_template('vrml.wrl')
+        template = self.gettemplate('vrml.wrl')
         roots = []
         modelfiles = {}
         for root in self._roots:
@@ -484,43 +757,76 @@ class VRMLWriter(object):
             modelfiles[mfname] = self._linkmap[r[0]]
         
         # render openhrp project
-        template = env.get_template('openhrp-project.xml')
+        template = self.gettemplate('openhrp-project.xml')
         with open(fname.replace('.wrl', '-project.xml'), 'w') as ofile:
-            ofile.write(template.render({
+            template.stream({
                 'models': modelfiles,
-            }))
+            }).dump(ofile)
 
         # render choreonoid project
-        template = env.get_template('choreonoid-project.yaml')
+        template = self.gettemplate('choreonoid-project.yaml')
         with open(fname.replace('.wrl', '-project.cnoid'), 'w') as ofile:
-            ofile.write(template.render({
+            template.stream({
                 'models': modelfiles,
-            }))
+            }).dump(ofile)
+
+    def computerelatives(self, mdata, rootjoint):
+        '''
+        Compute joint matrices relative to parent joints and link matrices
+        relative to their joints for the whole tree at once
+        '''
+        edges = []
+        stack = [rootjoint]
+        while stack:
+            pjoint = stack.pop()
+            for cjoint in self._childjoints.get(pjoint.child, []):
+                edges.append((pjoint, cjoint, self._linkmap.get(cjoint.child)))
+                stack.append(cjoint)
+        # every joint is inverted once, although it is the parent of all
+        # its child joints and of its own link
+        jointindex = {id(rootjoint): 0}
+        parents = [self.getmatrix(rootjoint)]
+        for (pjoint, cjoint, clink) in edges:
+            if id(cjoint) not in jointindex:
+                jointindex[id(cjoint)] = len(parents)
+                parents.append(self.getmatrix(cjoint))
+        index = []
+        children = []
+        for (pjoint, cjoint, clink) in edges:
+            index.append(jointindex[id(pjoint)])
+            children.append(self.getmatrix(cjoint))
+        for (pjoint, cjoint, clink) in edges:
+            index.append(jointindex[id(cjoint)])
+            children.append(_IDENTITY4 if clink is None else self.getmatrix(clink))
+        mats = relativematrices(parents, children, index)
+        n = len(edges)
+        self._relatives = {}
+        for i, (pjoint, cjoint, clink) in enumerate(edges):
+            self._relatives[(id(pjoint), id(cjoint))] = (mats[i], mats[n + i])
 
     def convertchildren(self, mdata, pjoint, joints, links):
         children = []
         plink = self._linkmap[pjoint.child]
-        for cjoint in utils.findchildren(mdata, pjoint.child):
+        for cjoint in self._childjoints.get(pjoint.child, []):
             nmodel = {}
             try:
                 clink = self._linkmap[cjoint.child]
             except KeyError:
                 logging.warning("unable to find child link %s" % cjoint.child)
             (cchildren, joints, links) = self.convertchildren(mdata, cjoint, joints, links)
-            pjointinv = numpy.linalg.pinv(pjoint.getmatrix())
-            cjointinv = numpy.linalg.pinv(cjoint.getmatrix())
-            cjoint2 = copy.deepcopy(cjoint)
-            cjoint2.matrix = numpy.dot(pjointinv, cjoint.getmatrix())
+            (jointmat, linkmat) = self._relatives[(id(pjoint), id(cjoint))]
+            cjoint2 = cjoint.clone()
+            cjoint2.matrix = jointmat
             cjoint2.trans = None
             cjoint2.rot = None
-            clink2 = copy.deepcopy(clink)
-            clink2.matrix = numpy.dot(cjointinv, clink.getmatrix())
+            clink2 = clink.clone()
+            clink2.matrix = linkmat
             clink2.trans = None
             clink2.rot = None
             if clink2.mass == 0:
                 logging.warning("detect link with mass zero, assigning small (0.001) mass.")
                 clink2.mass = 0.001
-            if not numpy.allclose(clink2.getmatrix(), numpy.identity(4)):
+            if not isidentity(clink2.getmatrix()):
                 clink2.translate(clink2.getmatrix())
             nmodel['joint'] = cjoint2
             nmodel['jointtype'] = self.convertjointtype(cjoint.jointType)
@@ -531,6 +837,39 @@ class VRMLWriter(object):
             links.append(cjoint.child)
         return (children, joints, links)
 
+    @classmethod
+    def gettemplate(cls, name):
+        '''
+        Get compiled template, the environment and templates are loaded only once
+        '''
+        if VRMLWriter._env is None:
+            loader = jinja2.PackageLoader(cls.__module__, 'template')
+            VRMLWriter._env = jinja2.Environment(loader=loader, extensions=['jinja2.ext.do'],
+                                                 auto_reload=False, cache_size=400)
+            for n in ['vrml.wrl', 'vrml-mesh.wrl', 'openhrp-project.xml', 'choreonoid-project.yaml']:
+                VRMLWriter._templates[n] = VRMLWriter._env.get_template(n)
+        try:
+            return VRMLWriter._templates[name]
+        except KeyError:
+            template = VRMLWriter._env.get_template(name)
+            VRMLWriter._templates[name] = template
+            return template
+
+    def getmatrix(self, m):
+        '''
+        Get transformation matrix of the model, cached during the write
+        '''
+        # keep reference to the model so that its id is not reused
+        try:
+            (cm, mat) = self._matrixcache[id(m)]
+            if cm is m:
+                return mat
+        except KeyError:
+            pass
+        mat = m.getmatrix()
+        self._matrixcache[id(m)] = (m, mat)
+        return mat
+
     def renderchildren(self, mdata, root, jointtype, fname, shapefilemap, template):
         nmodel = {}
         rootlink = self._linkmap[root]
@@ -541,6 +880,11 @@ class VRMLWriter(object):
         rootjoint.trans = None
         rootjoint.rot = None
         rootjoint.child = root
+        # child joints of each link (same order as utils.findchildren)
+        self._childjoints = {}
+        for j in mdata.joints:
+            self._childjoints.setdefault(j.parent, []).append(j)
+        self.computerelatives(mdata, rootjoint)
         (children, joints, links) = self.convertchildren(mdata, rootjoint, [], [])
         nmodel['link'] = rootlink
         nmodel['joint'] = rootjoint
@@ -560,8 +904,8 @@ class VRMLWriter(object):
             jointmap[j] = jointcount
             jointcount = jointcount + 1
 
-        with open(fname, 'w') as ofile:
-            ofile.write(template.render({
+        with open(fname, 'w', buffering=1 << 20) as ofile:
+            template.stream({
                 'model': {'name':rootlink.name, 'children':[nmodel]},
                 'body': mdata,
                 'links': links,
@@ -570,7 +914,7 @@ class VRMLWriter(object):
                 'ShapeModel': model.ShapeModel,
                 'shapefilemap': shapefilemap,
                 'options': self._options
-            }))
+            }).dump(ofile)
 
     def convertjointtype(self, t):
         if t == model.JointModel.J_FIXED:
@@ -604,17 +948,15 @@ class VRMLMeshWriter(object):
         dirname = os.path.dirname(fname)
 
         # render the data structure using template
-        loader = jinja2.PackageLoader(self.__module__, 'template')
-        env = jinja2.Environment(loader=loader, extensions=['jinja2.ext.do'])
-        template = env.get_template('vrml-mesh.wrl')
+        template = VRMLWriter.gettemplate('vrml-mesh.wrl')
         if m.shapeType == model.ShapeModel.SP_MESH:
             if isinstance(m.data, model.MeshTransformData):
                 m.data.pretranslate()
             nm = {}
             nm['children'] = [m.data]
-            with open(fname, 'w') as ofile:
-                ofile.write(template.render({
+            with open(fname, 'w', buffering=1 << 20) as ofile:
+                template.stream({
                     'name': basename,
                     'ShapeModel': model.ShapeModel,
                     'mesh': nm
-                }))
+                }).dump(ofile)
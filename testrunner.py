@@ -2,6 +2,7 @@
 
 import doctest
 import simtrans.utils
+import simtrans.catxml
 import simtrans.model
 import simtrans.collada
 import simtrans.urdf
@@ -25,6 +26,7 @@ hrpprefix = subprocess.check_output('pkg-config openhrp3.1 --variable=prefix', s
 os.environ['OPENHRP_MODEL_PATH'] = hrpprefix + '/share/OpenHRP-3.1/sample/model'
 
 doctest.testmod(simtrans.utils)
+doctest.testmod(simtrans.catxml)
 doctest.testmod(simtrans.model)
 doctest.testmod(simtrans.collada)
 doctest.testmod(simtrans.urdf)
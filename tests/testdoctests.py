@@ -1,6 +1,7 @@
 import unittest
 import doctest
 import simtrans.utils
+import simtrans.catxml
 import simtrans.collada
 import simtrans.urdf
 import simtrans.sdf
@@ -10,6 +11,7 @@ import simtrans.graphviz
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(simtrans.utils))
+    tests.addTests(doctest.DocTestSuite(simtrans.catxml))
     tests.addTests(doctest.DocTestSuite(simtrans.collada))
     tests.addTests(doctest.DocTestSuite(simtrans.urdf))
     tests.addTests(doctest.DocTestSuite(simtrans.sdf))